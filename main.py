@@ -1,14 +1,23 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import Optional
 import sqlite3
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import threading
+import weakref
+import asyncio
+import sys
+import json
+import logging
+import re
+from array import array
 
 app = FastAPI(title="Pixel Canvas API")
+logger = logging.getLogger(__name__)
 
 # CORS for frontend
 app.add_middleware(
@@ -30,30 +39,245 @@ FREE_WINDOW_SIZE = 5000  # last N placements are free
 INACTIVITY_THRESHOLD_SECONDS = 1800  # 30 minutes
 FREE_ELIGIBILITY_MAX_PAID = 500  # max paid placements for free eligibility
 RATE_LIMIT_SECONDS = 1  # min seconds between placements per user
+WEEK_SECONDS = 7 * 24 * 60 * 60
+PIXEL_SET = 1 << 24  # /board.bin flag bit marking a painted pixel (low 24 bits are RGB)
+AD_FLAG = 1 << 25  # packed into pixels.color (and /board.bin) for ad pixels
+MAX_COLOR = 0xFFFFFF  # colors are stored as 24-bit 0xRRGGBB integers
+HEX_COLOR_PATTERN = re.compile(r"^#[0-9A-Fa-f]{6}$")
 
-# In-memory rate limiting
-user_last_placement = {}
-rate_limit_lock = threading.Lock()
+# In-memory rate limiting: user_id -> last placement (monotonic ns), sharded by user_id
+RATE_LIMIT_NS = RATE_LIMIT_SECONDS * 1_000_000_000
+RATE_LIMIT_SHARDS = 64
+RATE_LIMIT_TTL_NS = 300 * 1_000_000_000  # entries older than this can no longer reject anything
+RATE_LIMIT_SWEEP_INTERVAL_SECONDS = 60
+# Only touched from the event loop (place_pixel and the eviction sweep), with no
+# await between check and set, so no lock is needed
+rate_limit_shards = [{} for _ in range(RATE_LIMIT_SHARDS)]
+
+# In-memory count of this week's placements (seeded from the DB at startup)
+week_placement_count = 0
+week_count_lock = threading.Lock()
+
+# Hot global_state values live in memory and are flushed to the DB lazily
+# (week_start and last_placement are Unix timestamps, as in global_state)
+STATE = {"last_placement": 0.0, "week_start": 0, "current_cap": INITIAL_CAP_CREDITS,
+         "week_epoch": 0}
+_state_lock = threading.Lock()
+_state_dirty = False
+STATE_FLUSH_INTERVAL_SECONDS = 5
+
+# /place requests are queued and committed together, up to this many per fsync
+PLACE_BATCH_SIZE = 64
+
+# In-memory copy of the board colors served by /board.bin (see PIXEL_SET)
+BOARD = array("I", [0]) * (BOARD_SIZE * BOARD_SIZE)
+board_version = 0  # bumped on every placement and weekly reset; forms the ETags
+board_lock = threading.Lock()
+BOOT_ID = int(time.time())  # keeps ETags from colliding across restarts
+
+# This week's cost level per pixel, owned by db_writer so /place and the cap
+# check skip SQLite. Reloaded from the DB if a batch fails to commit.
+# Stored as uint16 in COST_INCREMENT_CREDITS steps (placements this week),
+# saturating at MAX_LEVEL_STEPS, far past where the cap applies.
+LEVELS = array("H", [0]) * (BOARD_SIZE * BOARD_SIZE)
+MAX_LEVEL_STEPS = 0xFFFF
+levels_epoch = 0  # week_epoch that LEVELS belongs to
+pixels_at_cap = 0  # LEVELS entries at or above cap_cost_level(INITIAL_CAP_CREDITS)
+
+# Encoded /board and /stats bodies: endpoint -> (board_version, body bytes)
+_response_cache = {}
+# One lock per endpoint so only one thread rebuilds each version
+_response_build_locks = {"board": threading.Lock(), "stats": threading.Lock()}
 
 DB_PATH = "pixelcanvas.db"
+PAGE_SIZE = 8192  # bytes; larger pages mean fewer reads for full-board scans
+BUSY_TIMEOUT_MS = 5000  # wait for the writer lock instead of raising SQLITE_BUSY
+
+# Per-connection tuning (journal_mode=WAL is persistent and set once in init_db)
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MiB
+    "PRAGMA cache_size=-65536",  # 64 MiB
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA wal_autocheckpoint=1000",  # SQLite's default, pinned explicitly
+)
+STATEMENT_CACHE_SIZE = 256
+
+# /place hot-path SQL. sqlite3 caches prepared statements keyed by the exact
+# string, so these are shared verbatim rather than rebuilt per call.
+SQL_SELECT_USER = "SELECT credits, lifetime_paid_placements FROM users WHERE id = ?"
+SQL_UPDATE_USER_DEBIT = """
+    UPDATE users
+    SET credits = credits - ?,
+        lifetime_paid_placements = lifetime_paid_placements + 1
+    WHERE id = ?
+"""
+SQL_UPSERT_PIXEL = """
+    INSERT INTO pixels (x, y, color, cost_level, week_epoch, owner_id, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
+    ON CONFLICT(x, y) DO UPDATE SET
+        color = excluded.color,
+        cost_level = excluded.cost_level,
+        week_epoch = excluded.week_epoch,
+        owner_id = excluded.owner_id,
+        updated_at = excluded.updated_at
+"""
+SQL_INSERT_PLACEMENT = """
+    INSERT INTO placements (user_id, x, y, color, cost, was_free, is_ad, placed_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))
+"""
+BOARD_JSON_PREFIX = f'{{"width":{BOARD_SIZE},"height":{BOARD_SIZE},"pixels":'.encode()
+# Serialized by SQLite's JSON1 and returned as bytes, so /board builds no
+# per-pixel Python objects and never holds a str copy of the document
+SQL_SELECT_BOARD_JSON = f"""
+    SELECT CAST(json_group_array(json_object(
+        'x', x,
+        'y', y,
+        'color', printf('#%06x', color & {MAX_COLOR}),
+        'cost_level', CASE WHEN week_epoch = ? THEN cost_level ELSE 0 END,
+        'owner_id', owner_id,
+        'is_ad', json(CASE WHEN color & {AD_FLAG} THEN 'true' ELSE 'false' END),
+        'updated_at', updated_at
+    )) AS BLOB)
+    FROM (SELECT * FROM pixels ORDER BY x, y)
+"""
+SQL_UPDATE_STATE = """
+    UPDATE global_state
+    SET value = ?, updated_at = datetime('now')
+    WHERE key = ?
+"""
+
+# All writes run on one thread; SQLite only admits one writer at a time anyway,
+# and this keeps blocking sqlite3 calls off the event loop
+db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+async def run_in_writer(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(db_writer, func, *args)
+
+# Connection pool: one long-lived connection per thread
+_POOL = threading.local()
+
+class _PooledConnection:
+    """A thread's connection, closed once the thread exits (AnyIO retires
+    idle worker threads) or at interpreter exit, whichever comes first"""
+    def __init__(self):
+        # check_same_thread=False only so the finalizer can close it; the
+        # connection is otherwise used by the thread that opened it
+        self.conn = sqlite3.connect(DB_PATH, check_same_thread=False,
+                                    cached_statements=STATEMENT_CACHE_SIZE)
+        self.conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            self.conn.execute(pragma)
+        weakref.finalize(self, self.conn.close)
+
+def _get_pooled_connection():
+    pooled = getattr(_POOL, "pooled", None)
+    if pooled is None:
+        pooled = _POOL.pooled = _PooledConnection()
+    return pooled.conn
 
 # Database helper
 @contextmanager
-def get_db():
-    conn = sqlite3.connect(DB_PATH, isolation_level="IMMEDIATE")
-    conn.row_factory = sqlite3.Row
+def get_db(immediate=False):
+    """Borrow this thread's connection; pass immediate=True for endpoints that write"""
+    conn = _get_pooled_connection()
+    conn.isolation_level = "IMMEDIATE" if immediate else "DEFERRED"
+    if immediate:
+        # Take the writer lock up front so reads in the block are serialized too
+        conn.execute("BEGIN IMMEDIATE")
     try:
         yield conn
         conn.commit()
     except Exception as e:
         conn.rollback()
         raise e
-    finally:
-        conn.close()
+
+# Schema
+SQL_CREATE_PIXELS = """
+    CREATE TABLE IF NOT EXISTS pixels (
+        x INTEGER NOT NULL,
+        y INTEGER NOT NULL,
+        color INTEGER NOT NULL,
+        cost_level INTEGER DEFAULT 0,
+        week_epoch INTEGER DEFAULT 0,
+        owner_id INTEGER,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (x, y),
+        FOREIGN KEY (owner_id) REFERENCES users(id)
+    )
+"""
+SQL_CREATE_PLACEMENTS = """
+    CREATE TABLE IF NOT EXISTS placements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        x INTEGER NOT NULL,
+        y INTEGER NOT NULL,
+        color INTEGER NOT NULL,
+        cost INTEGER NOT NULL,
+        was_free BOOLEAN DEFAULT 0,
+        is_ad BOOLEAN DEFAULT 0,
+        placed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+"""
+
+def parse_hex_color(value):
+    """Convert '#rrggbb' to a 0xRRGGBB integer"""
+    return int(value[1:], 16)
+
+def migrate_text_colors(conn):
+    """Rebuild pixels/placements created with '#rrggbb' TEXT colors as INTEGER"""
+    conn.create_function("parse_hex_color", 1, parse_hex_color, deterministic=True)
+    cursor = conn.cursor()
+    for table, create_sql, columns, color_expr in (
+        ("pixels", SQL_CREATE_PIXELS,
+         ("x", "y", "color", "cost_level", "week_epoch", "owner_id", "updated_at"),
+         f"parse_hex_color(color) | CASE WHEN is_ad THEN {AD_FLAG} ELSE 0 END"),
+        ("placements", SQL_CREATE_PLACEMENTS,
+         ("id", "user_id", "x", "y", "color", "cost", "was_free", "is_ad", "placed_at"),
+         "parse_hex_color(color)"),
+    ):
+        cursor.execute(f"PRAGMA table_info({table})")
+        column_types = {row[1]: row[2] for row in cursor.fetchall()}
+        if column_types.get("color") != "TEXT":
+            continue
+        
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {table}_text_colors")
+        cursor.execute(create_sql)
+        select_columns = [color_expr if c == "color" else c for c in columns]
+        cursor.execute(f"""
+            INSERT INTO {table} ({", ".join(columns)})
+            SELECT {", ".join(select_columns)} FROM {table}_text_colors
+        """)
+        cursor.execute(f"DROP TABLE {table}_text_colors")
+
+def migrate_pixel_ad_flags(conn):
+    """Fold the old pixels.is_ad column into the AD_FLAG bit of color"""
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(pixels)")
+    if "is_ad" not in [row[1] for row in cursor.fetchall()]:
+        return
+    cursor.execute(f"UPDATE pixels SET color = color | {AD_FLAG} WHERE is_ad")
+    cursor.execute("ALTER TABLE pixels DROP COLUMN is_ad")
 
 # Initialize database
 def init_db():
-    with get_db() as conn:
+    # WAL lets /board and /stats read while /place writes, and is
+    # remembered by the database file once set
+    bootstrap = sqlite3.connect(DB_PATH)
+    try:
+        # page_size only applies to new databases or after VACUUM, and
+        # cannot change while in WAL mode
+        if bootstrap.execute("PRAGMA page_size").fetchone()[0] != PAGE_SIZE:
+            bootstrap.execute("PRAGMA journal_mode=DELETE")
+            bootstrap.execute(f"PRAGMA page_size={PAGE_SIZE}")
+            bootstrap.execute("VACUUM")
+        bootstrap.execute("PRAGMA journal_mode=WAL")
+    finally:
+        bootstrap.close()
+    
+    with get_db(immediate=True) as conn:
         cursor = conn.cursor()
         
         # Users table
@@ -68,35 +292,19 @@ def init_db():
         """)
         
         # Pixels table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS pixels (
-                x INTEGER NOT NULL,
-                y INTEGER NOT NULL,
-                color TEXT NOT NULL,
-                cost_level INTEGER DEFAULT 0,
-                owner_id INTEGER,
-                is_ad BOOLEAN DEFAULT 0,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (x, y),
-                FOREIGN KEY (owner_id) REFERENCES users(id)
-            )
-        """)
+        cursor.execute(SQL_CREATE_PIXELS)
+        
+        # cost_level only counts while week_epoch matches the current week
+        cursor.execute("PRAGMA table_info(pixels)")
+        if "week_epoch" not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE pixels ADD COLUMN week_epoch INTEGER DEFAULT 0")
         
         # Placements log
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS placements (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                x INTEGER NOT NULL,
-                y INTEGER NOT NULL,
-                color TEXT NOT NULL,
-                cost INTEGER NOT NULL,
-                was_free BOOLEAN DEFAULT 0,
-                is_ad BOOLEAN DEFAULT 0,
-                placed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        """)
+        cursor.execute(SQL_CREATE_PLACEMENTS)
+        
+        # Databases from before colors were INTEGER
+        migrate_text_colors(conn)
+        migrate_pixel_ad_flags(conn)
         
         # Global state
         cursor.execute("""
@@ -107,19 +315,36 @@ def init_db():
             )
         """)
         
-        # Initialize global state
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_placements_placed_at
+            ON placements(placed_at)
+        """)
+        # Cost levels are tracked in LEVELS now; this index only slowed /place
+        cursor.execute("DROP INDEX IF EXISTS idx_pixels_cost_level")
+        
+        # Initialize global state (timestamps are Unix seconds)
         cursor.execute("""
             INSERT OR IGNORE INTO global_state (key, value)
-            VALUES ('week_start', datetime('now'))
+            VALUES ('week_start', strftime('%s', 'now'))
         """)
         cursor.execute("""
             INSERT OR IGNORE INTO global_state (key, value)
-            VALUES ('last_placement', datetime('now'))
+            VALUES ('last_placement', strftime('%s', 'now'))
         """)
         cursor.execute("""
             INSERT OR IGNORE INTO global_state (key, value)
             VALUES ('current_cap', ?)
         """, (str(INITIAL_CAP_CREDITS),))
+        cursor.execute("""
+            INSERT OR IGNORE INTO global_state (key, value)
+            VALUES ('week_epoch', '0')
+        """)
+        
+        # Databases from before timestamps were stored as Unix seconds
+        cursor.execute("""
+            UPDATE global_state SET value = strftime('%s', value)
+            WHERE key IN ('week_start', 'last_placement') AND value LIKE '%-%'
+        """)
         
         conn.commit()
 
@@ -128,8 +353,17 @@ class PlacePixelRequest(BaseModel):
     user_id: int
     x: int = Field(..., ge=0, lt=BOARD_SIZE)
     y: int = Field(..., ge=0, lt=BOARD_SIZE)
-    color: str = Field(..., pattern="^#[0-9A-Fa-f]{6}$")
+    color: int = Field(..., ge=0, le=MAX_COLOR)  # accepts "#rrggbb" or 0xRRGGBB
     is_ad: bool = False
+    
+    @field_validator("color", mode="before")
+    @classmethod
+    def parse_color(cls, value):
+        if isinstance(value, str):
+            if not HEX_COLOR_PATTERN.match(value):
+                raise ValueError("color must be '#rrggbb'")
+            return parse_hex_color(value)
+        return value
 
 class BoardResponse(BaseModel):
     width: int
@@ -144,41 +378,224 @@ class PlacePixelResponse(BaseModel):
     message: str
 
 # Helper functions
-def get_week_start(conn):
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM global_state WHERE key = 'week_start'")
-    row = cursor.fetchone()
-    return datetime.fromisoformat(row[0])
+def get_week_start():
+    with _state_lock:
+        return STATE["week_start"]
 
-def get_last_placement_time(conn):
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM global_state WHERE key = 'last_placement'")
-    row = cursor.fetchone()
-    return datetime.fromisoformat(row[0])
+def get_last_placement_time():
+    with _state_lock:
+        return STATE["last_placement"]
 
-def get_current_cap(conn):
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM global_state WHERE key = 'current_cap'")
-    row = cursor.fetchone()
-    return int(row[0])
+def format_timestamp(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds")
+
+def get_current_cap():
+    with _state_lock:
+        return STATE["current_cap"]
+
+def get_week_epoch():
+    with _state_lock:
+        return STATE["week_epoch"]
+
+def set_state(key, value):
+    global _state_dirty
+    with _state_lock:
+        STATE[key] = value
+        _state_dirty = True
+
+def snapshot_state():
+    with _state_lock:
+        return dict(STATE), _state_dirty
+
+def restore_state(snapshot):
+    """Undo set_state calls made by a transaction that failed to commit"""
+    global _state_dirty
+    values, dirty = snapshot
+    with _state_lock:
+        STATE.update(values)
+        _state_dirty = dirty
+
+def load_state():
+    """Load the hot global_state values into STATE"""
+    global _state_dirty
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT key, value FROM global_state
+            WHERE key IN ('last_placement', 'week_start', 'current_cap', 'week_epoch')
+        """)
+        values = dict(cursor.fetchall())
+    with _state_lock:
+        STATE["last_placement"] = float(values["last_placement"])
+        STATE["week_start"] = int(values["week_start"])
+        STATE["current_cap"] = int(values["current_cap"])
+        STATE["week_epoch"] = int(values["week_epoch"])
+        _state_dirty = False
+
+def flush_state():
+    """Persist STATE to global_state if it changed since the last flush"""
+    global _state_dirty
+    with _state_lock:
+        if not _state_dirty:
+            return
+        last_placement = STATE["last_placement"]
+        current_cap = STATE["current_cap"]
+        _state_dirty = False
+    try:
+        with get_db(immediate=True) as conn:
+            conn.executemany(SQL_UPDATE_STATE, [
+                (str(int(last_placement)), "last_placement"),
+                (str(current_cap), "current_cap"),
+            ])
+    except Exception:
+        # Keep the values pending for the next flush
+        with _state_lock:
+            _state_dirty = True
+        raise
+
+def try_acquire_placement_slot(user_id, now_ns):
+    """Record a placement attempt; False if the user is still rate limited"""
+    last_placement = rate_limit_shards[user_id % RATE_LIMIT_SHARDS]
+    prev = last_placement.get(user_id)
+    if prev is not None and now_ns - prev < RATE_LIMIT_NS:
+        return False
+    last_placement[user_id] = now_ns
+    return True
+
+def evict_stale_rate_limits(now_ns):
+    for last_placement in rate_limit_shards:
+        stale = [user_id for user_id, ts in last_placement.items()
+                 if now_ns - ts > RATE_LIMIT_TTL_NS]
+        for user_id in stale:
+            del last_placement[user_id]
+
+async def evict_rate_limits_periodically():
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SWEEP_INTERVAL_SECONDS)
+        evict_stale_rate_limits(time.monotonic_ns())
+
+def load_board():
+    """Fill BOARD from the pixels table"""
+    global board_version
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT x, y, color FROM pixels")
+        with board_lock:
+            for x, y, color in cursor:
+                BOARD[y * BOARD_SIZE + x] = PIXEL_SET | color
+            board_version += 1
+
+def load_levels():
+    """Fill LEVELS from the current week's cost levels"""
+    global levels_epoch, pixels_at_cap
+    week_epoch = get_week_epoch()
+    threshold = cap_cost_level(INITIAL_CAP_CREDITS)
+    levels = array("H", [0]) * (BOARD_SIZE * BOARD_SIZE)
+    at_cap = 0
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT x, y, cost_level FROM pixels WHERE week_epoch = ?", (week_epoch,))
+        for x, y, cost_level in cursor:
+            levels[y * BOARD_SIZE + x] = min(cost_level // COST_INCREMENT_CREDITS, MAX_LEVEL_STEPS)
+            at_cap += cost_level >= threshold
+    LEVELS[:] = levels
+    levels_epoch = week_epoch
+    pixels_at_cap = at_cap
+
+def get_cost_level(index):
+    return LEVELS[index] * COST_INCREMENT_CREDITS
+
+def record_cost_level(index, old_level, new_level):
+    global pixels_at_cap
+    LEVELS[index] = min(new_level // COST_INCREMENT_CREDITS, MAX_LEVEL_STEPS)
+    if old_level < cap_cost_level(INITIAL_CAP_CREDITS) <= new_level:
+        pixels_at_cap += 1
+
+def board_etag(version):
+    return f'"{BOOT_ID}-{version}"'
+
+def get_board_version():
+    with board_lock:
+        return board_version
+
+def cached_json_response(name, if_none_match, build):
+    """Serve build()'s JSON bytes, rebuilt once per board_version and shared by
+    every request for that version (the version is read before building)"""
+    version = get_board_version()
+    etag = board_etag(version)
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    cached = _response_cache.get(name)
+    if cached is None or cached[0] < version:
+        with _response_build_locks[name]:
+            # Another thread may have rebuilt it while we waited
+            cached = _response_cache.get(name)
+            if cached is None or cached[0] < version:
+                cached = (version, build())
+                _response_cache[name] = cached
+    return Response(content=cached[1], media_type="application/json",
+                    headers={"ETag": board_etag(cached[0])})
+
+async def flush_state_periodically():
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL_SECONDS)
+        # Also roll the week over when nobody is placing, so /board and
+        # /stats (which only read) don't keep showing last week. A failure
+        # (e.g. SQLITE_BUSY) is retried next round rather than ending the task
+        for job in (roll_over_week, flush_state):
+            try:
+                await run_in_writer(job)
+            except Exception:
+                logger.exception("%s failed; retrying in %ss", job.__name__,
+                                 STATE_FLUSH_INTERVAL_SECONDS)
+
+def roll_over_week():
+    """Start a new week if the current one is over (runs on db_writer)"""
+    if time.time() - get_week_start() < WEEK_SECONDS:
+        return False
+    saved_state = snapshot_state()
+    try:
+        with get_db(immediate=True) as conn:
+            if not check_and_reset_week(conn):
+                return False
+    except Exception:
+        restore_state(saved_state)
+        raise
+    finish_week_reset()
+    return True
 
 def check_and_reset_week(conn):
-    """Check if a week has passed and reset if needed"""
-    week_start = get_week_start(conn)
-    now = datetime.now()
+    """Check if a week has passed and reset if needed.
     
-    if now - week_start >= timedelta(days=7):
+    Only called on db_writer, which is what keeps STATE and global_state in
+    step for the placements that follow. Leaves the commit to the caller, who
+    then calls finish_week_reset().
+    """
+    week_start = get_week_start()
+    now = time.time()
+    
+    if now - week_start >= WEEK_SECONDS:
         cursor = conn.cursor()
         
-        # Reset all pixel cost levels
-        cursor.execute("UPDATE pixels SET cost_level = 0")
-        
-        # Reset week start
+        # Reset week start, only if global_state still holds the week we saw
+        new_week_start = int(now)
         cursor.execute("""
             UPDATE global_state 
-            SET value = datetime('now'), updated_at = datetime('now')
-            WHERE key = 'week_start'
-        """)
+            SET value = ?, updated_at = datetime('now')
+            WHERE key = 'week_start' AND value = ?
+        """, (str(new_week_start), str(week_start)))
+        if cursor.rowcount == 0:
+            return False
+        
+        # Reset all pixel cost levels: rows from older epochs read as level 0,
+        # so bumping the epoch replaces rewriting every pixel
+        week_epoch = get_week_epoch() + 1
+        cursor.execute("""
+            UPDATE global_state
+            SET value = ?, updated_at = datetime('now')
+            WHERE key = 'week_epoch'
+        """, (str(week_epoch),))
         
         # Reset cap
         cursor.execute("""
@@ -187,265 +604,308 @@ def check_and_reset_week(conn):
             WHERE key = 'current_cap'
         """, (str(INITIAL_CAP_CREDITS),))
         
-        conn.commit()
+        with _state_lock:
+            STATE["week_start"] = new_week_start
+            STATE["current_cap"] = INITIAL_CAP_CREDITS
+            STATE["week_epoch"] = week_epoch
         return True
     return False
 
+def finish_week_reset():
+    """Publish a committed week reset to the week counter and board version"""
+    global week_placement_count, board_version
+    with week_count_lock:
+        week_placement_count = 0
+    with board_lock:
+        board_version += 1
+
 def count_week_placements(conn):
-    """Count placements this week"""
-    week_start = get_week_start(conn)
+    """Count placements this week (index scan; prefer get_week_placement_count)"""
     cursor = conn.cursor()
     cursor.execute("""
         SELECT COUNT(*) FROM placements
-        WHERE placed_at >= ?
-    """, (week_start.isoformat(),))
+        WHERE placed_at >= datetime(?, 'unixepoch')
+    """, (get_week_start(),))
     return cursor.fetchone()[0]
 
-def is_free_placement_eligible(conn, user_id):
-    """Check if placement should be free"""
-    
-    # Check inactivity free mode
-    last_placement = get_last_placement_time(conn)
-    now = datetime.now()
-    inactive_seconds = (now - last_placement).total_seconds()
-    
-    if inactive_seconds >= INACTIVITY_THRESHOLD_SECONDS:
-        # Check user's lifetime paid placements
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT lifetime_paid_placements FROM users WHERE id = ?
-        """, (user_id,))
-        row = cursor.fetchone()
-        if row and row[0] <= FREE_ELIGIBILITY_MAX_PAID:
-            return True, "inactivity"
+def load_week_placement_count():
+    """Seed the in-memory week counter from the placements log"""
+    global week_placement_count
+    with get_db() as conn:
+        count = count_week_placements(conn)
+    with week_count_lock:
+        week_placement_count = count
+
+def get_week_placement_count():
+    with week_count_lock:
+        return week_placement_count
+
+def is_free_placement_eligible(lifetime_paid, last_placement, week_start, now):
+    """Check if placement should be free (no DB access; callers pass state in)"""
+    inactive_seconds = now - last_placement
+    # Simplified stand-in for "last 5000 placements of the week":
+    # the last 6 hours of the week are the free window
+    time_remaining = week_start + WEEK_SECONDS - now
     
-    # Check last 5000 placements
-    week_count = count_week_placements(conn)
-    week_start = get_week_start(conn)
+    # Outside both free windows - the common case - nothing else matters
+    if inactive_seconds < INACTIVITY_THRESHOLD_SECONDS and time_remaining >= 21600:
+        return False, None
     
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT COUNT(*) FROM placements
-        WHERE placed_at >= ? AND placed_at < datetime('now', '-7 days')
-    """, (week_start.isoformat(),))
+    if lifetime_paid > FREE_ELIGIBILITY_MAX_PAID:
+        return False, None
     
-    # Simplified: if we're in the last 5000 placements of the week
-    # We'll use a simpler heuristic: check total week placements
-    # This is approximate but correct for Phase 1
-    cursor.execute("""
-        SELECT COUNT(*) FROM placements
-        WHERE placed_at >= ?
-    """, (week_start.isoformat(),))
-    total_this_week = cursor.fetchone()[0]
-    
-    # Estimate end of week
-    week_start_dt = get_week_start(conn)
-    week_end = week_start_dt + timedelta(days=7)
-    time_remaining = (week_end - now).total_seconds()
-    
-    # If less than certain time remains and user qualifies, could be in free window
-    # For now, simplified: last 6 hours of week are free window candidate
-    if time_remaining < 21600:  # 6 hours
-        cursor.execute("""
-            SELECT lifetime_paid_placements FROM users WHERE id = ?
-        """, (user_id,))
-        row = cursor.fetchone()
-        if row and row[0] <= FREE_ELIGIBILITY_MAX_PAID:
-            return True, "end_of_week"
+    # Check inactivity free mode
+    if inactive_seconds >= INACTIVITY_THRESHOLD_SECONDS:
+        return True, "inactivity"
     
-    return False, None
+    return True, "end_of_week"
 
-def calculate_pixel_cost(conn, x, y):
+def calculate_pixel_cost(cost_level, current_cap):
     """Calculate cost to place pixel"""
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT cost_level FROM pixels WHERE x = ? AND y = ?
-    """, (x, y))
-    row = cursor.fetchone()
-    
-    cost_level = row[0] if row else 0
     base_cost = BASE_COST_CREDITS
     cost = base_cost + (cost_level * COST_INCREMENT_CREDITS // 1000)
     
     # Apply cap
-    current_cap = get_current_cap(conn)
     cost = min(cost, current_cap)
     
     return cost
 
-def update_dynamic_cap(conn):
+def cap_cost_level(cap):
+    """Lowest cost_level whose calculate_pixel_cost reaches cap"""
+    return -(-(cap - BASE_COST_CREDITS) * 1000 // COST_INCREMENT_CREDITS)
+
+def update_dynamic_cap(current_cap):
     """Check if cap should be lowered"""
-    current_cap = get_current_cap(conn)
-    
-    if current_cap == INITIAL_CAP_CREDITS:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT COUNT(*) FROM pixels
-            WHERE cost_level >= ?
-        """, (current_cap // COST_INCREMENT_CREDITS * 1000,))
-        
-        count = cursor.fetchone()[0]
-        
-        if count >= CAP_TRIGGER_COUNT:
-            cursor.execute("""
-                UPDATE global_state
-                SET value = ?, updated_at = datetime('now')
-                WHERE key = 'current_cap'
-            """, (str(LOWER_CAP_CREDITS),))
-            conn.commit()
+    if current_cap == INITIAL_CAP_CREDITS and pixels_at_cap >= CAP_TRIGGER_COUNT:
+        set_state("current_cap", LOWER_CAP_CREDITS)
 
 # API Endpoints
 @app.on_event("startup")
 async def startup_event():
     init_db()
+    load_state()
+    load_week_placement_count()
+    load_board()
+    load_levels()
+    app.state.place_queue = asyncio.Queue()
+    app.state.placement_task = asyncio.create_task(process_placements())
+    app.state.flush_task = asyncio.create_task(flush_state_periodically())
+    app.state.rate_limit_task = asyncio.create_task(evict_rate_limits_periodically())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.placement_task.cancel()
+    app.state.flush_task.cancel()
+    app.state.rate_limit_task.cancel()
+    await run_in_writer(flush_state)
 
 @app.get("/")
 async def root():
     return {"message": "Pixel Canvas API - Phase 1", "version": "0.1.0"}
 
+# Read endpoints are plain defs so FastAPI runs them in its threadpool (each
+# worker thread has its own pooled connection); writes go through db_writer
 @app.get("/board", response_model=BoardResponse)
-async def get_board():
+def get_board(if_none_match: Optional[str] = Header(None)):
     """Get current board state"""
     with get_db() as conn:
-        check_and_reset_week(conn)
-        
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT x, y, color, cost_level, owner_id, is_ad, updated_at
-            FROM pixels
-            ORDER BY x, y
-        """)
-        
-        pixels = []
-        for row in cursor.fetchall():
-            pixels.append({
-                "x": row[0],
-                "y": row[1],
-                "color": row[2],
-                "cost_level": row[3],
-                "owner_id": row[4],
-                "is_ad": bool(row[5]),
-                "updated_at": row[6]
-            })
-        
-        return BoardResponse(
-            width=BOARD_SIZE,
-            height=BOARD_SIZE,
-            pixels=pixels
-        )
+        def build():
+            cursor = conn.cursor()
+            cursor.execute(SQL_SELECT_BOARD_JSON, (get_week_epoch(),))
+            pixels_json = cursor.fetchone()[0]
+            cursor.close()
+            # Already-encoded JSON; skip response_model re-encoding. Wrapping
+            # the array in json_object() in SQL re-parses it, which peaks higher
+            return b"".join((BOARD_JSON_PREFIX, pixels_json, b"}"))
+        
+        return cached_json_response("board", if_none_match, build)
+
+@app.get("/board.bin")
+async def get_board_binary(if_none_match: Optional[str] = Header(None)):
+    """Get board colors as BOARD_SIZE*BOARD_SIZE little-endian uint32, row-major.
+    
+    Each value is PIXEL_SET | 0xRRGGBB for painted pixels (plus AD_FLAG for
+    ads) and 0 otherwise.
+    """
+    with board_lock:
+        etag = board_etag(board_version)
+        if if_none_match == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        content = BOARD.tobytes()
+    
+    if sys.byteorder == "big":
+        swapped = array("I", content)
+        swapped.byteswap()
+        content = swapped.tobytes()
+    return Response(content=content, media_type="application/octet-stream",
+                    headers={"ETag": etag})
 
 @app.post("/place", response_model=PlacePixelResponse)
 async def place_pixel(request: PlacePixelRequest):
     """Place a pixel on the board"""
-    
     # Rate limiting check
-    with rate_limit_lock:
-        now = time.time()
-        last_time = user_last_placement.get(request.user_id, 0)
-        
-        if now - last_time < RATE_LIMIT_SECONDS:
-            raise HTTPException(
-                status_code=429,
-                detail=f"Rate limit: wait {RATE_LIMIT_SECONDS} seconds between placements"
-            )
-        
-        user_last_placement[request.user_id] = now
+    if not try_acquire_placement_slot(request.user_id, time.monotonic_ns()):
+        raise HTTPException(
+            status_code=429,
+            detail=f"Rate limit: wait {RATE_LIMIT_SECONDS} seconds between placements"
+        )
     
-    with get_db() as conn:
-        check_and_reset_week(conn)
-        cursor = conn.cursor()
-        
-        # Validate user exists
-        cursor.execute("SELECT credits, lifetime_paid_placements FROM users WHERE id = ?", 
-                      (request.user_id,))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        user_credits = user_row[0]
-        lifetime_paid = user_row[1]
-        
-        # Check free placement eligibility
-        is_free, free_reason = is_free_placement_eligible(conn, request.user_id)
-        
-        # Calculate cost
-        cost = 0 if is_free else calculate_pixel_cost(conn, request.x, request.y)
-        
-        # Check sufficient credits
-        if not is_free and user_credits < cost:
-            raise HTTPException(
-                status_code=402,
-                detail=f"Insufficient credits. Need {cost}, have {user_credits}"
-            )
+    # Queued for process_placements, which commits placements in batches
+    future = asyncio.get_running_loop().create_future()
+    await app.state.place_queue.put((request, future))
+    return await future
+
+async def process_placements():
+    """Drain /place requests and group-commit them on db_writer"""
+    queue = app.state.place_queue
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < PLACE_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
         
-        # Deduct credits
-        if not is_free:
-            cursor.execute("""
-                UPDATE users
-                SET credits = credits - ?,
-                    lifetime_paid_placements = lifetime_paid_placements + 1
-                WHERE id = ?
-            """, (cost, request.user_id))
+        try:
+            results = await run_in_writer(commit_placements, [request for request, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        
+        for (_, future), result in zip(batch, results):
+            if future.cancelled():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+def commit_placements(requests):
+    """Apply placements in one IMMEDIATE transaction (runs on db_writer).
+    
+    Returns a PlacePixelResponse or an exception for each request; a failed
+    placement is rolled back to its savepoint without affecting the others.
+    """
+    global week_placement_count, board_version, levels_epoch, pixels_at_cap
+    results = []
+    placed = []
+    # apply_placement and the week reset update STATE as they go so the rest
+    # of the batch sees it; put it back if the batch doesn't commit
+    saved_state = snapshot_state()
+    
+    try:
+        with get_db(immediate=True) as conn:
+            # Commits together with the batch below
+            week_reset = check_and_reset_week(conn)
+            if levels_epoch != get_week_epoch():
+                LEVELS[:] = array("H", [0]) * len(LEVELS)
+                levels_epoch = get_week_epoch()
+                pixels_at_cap = 0
             
-            new_balance = user_credits - cost
-        else:
-            new_balance = user_credits
-        
-        # Get current pixel state
-        cursor.execute("""
-            SELECT cost_level FROM pixels WHERE x = ? AND y = ?
-        """, (request.x, request.y))
-        
-        existing_pixel = cursor.fetchone()
-        new_cost_level = (existing_pixel[0] if existing_pixel else 0) + COST_INCREMENT_CREDITS
-        
-        # Write/update pixel
-        cursor.execute("""
-            INSERT INTO pixels (x, y, color, cost_level, owner_id, is_ad, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
-            ON CONFLICT(x, y) DO UPDATE SET
-                color = excluded.color,
-                cost_level = excluded.cost_level,
-                owner_id = excluded.owner_id,
-                is_ad = excluded.is_ad,
-                updated_at = excluded.updated_at
-        """, (request.x, request.y, request.color, new_cost_level, 
-              request.user_id, request.is_ad))
-        
-        # Log placement
-        cursor.execute("""
-            INSERT INTO placements (user_id, x, y, color, cost, was_free, is_ad, placed_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))
-        """, (request.user_id, request.x, request.y, request.color, 
-              cost, is_free, request.is_ad))
-        
-        # Update last placement time
-        cursor.execute("""
-            UPDATE global_state
-            SET value = datetime('now'), updated_at = datetime('now')
-            WHERE key = 'last_placement'
-        """)
-        
-        conn.commit()
-        
-        # Update dynamic cap
-        update_dynamic_cap(conn)
-        
-        message = "Pixel placed"
-        if is_free:
-            message += f" (free: {free_reason})"
-        
-        return PlacePixelResponse(
-            success=True,
-            cost=cost,
-            was_free=is_free,
-            new_balance=new_balance,
-            message=message
+            for request in requests:
+                conn.execute("SAVEPOINT placement")
+                try:
+                    results.append(apply_placement(conn, request))
+                    placed.append(request)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO placement")
+                    results.append(e)
+                conn.execute("RELEASE placement")
+    except Exception:
+        # LEVELS already holds this batch's levels; bring it back in line
+        restore_state(saved_state)
+        load_levels()
+        raise
+    
+    if week_reset:
+        finish_week_reset()
+    
+    if placed:
+        with week_count_lock:
+            week_placement_count += len(placed)
+        
+        # Publish last, after every value /board and /stats read has changed
+        with board_lock:
+            for request in placed:
+                BOARD[request.y * BOARD_SIZE + request.x] = PIXEL_SET | pixel_color(request)
+            board_version += 1
+    
+    return results
+
+def pixel_color(request):
+    """pixels.color value for a placement: RGB plus AD_FLAG for ads"""
+    return request.color | (AD_FLAG if request.is_ad else 0)
+
+def apply_placement(conn, request):
+    """Write one placement inside commit_placements' transaction"""
+    cursor = conn.cursor()
+    
+    week_epoch = get_week_epoch()
+    cursor.execute(SQL_SELECT_USER, (request.user_id,))
+    user_row = cursor.fetchone()
+    
+    # Validate user exists
+    if not user_row:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    user_credits, lifetime_paid = user_row
+    
+    index = request.y * BOARD_SIZE + request.x
+    cost_level = get_cost_level(index)
+    current_cap = get_current_cap()
+    last_placement = get_last_placement_time()
+    week_start = get_week_start()
+    
+    # Check free placement eligibility
+    is_free, free_reason = is_free_placement_eligible(lifetime_paid, last_placement,
+                                                      week_start, time.time())
+    
+    # Calculate cost
+    cost = 0 if is_free else calculate_pixel_cost(cost_level, current_cap)
+    
+    # Check sufficient credits
+    if not is_free and user_credits < cost:
+        raise HTTPException(
+            status_code=402,
+            detail=f"Insufficient credits. Need {cost}, have {user_credits}"
         )
+    
+    # Deduct credits
+    if not is_free:
+        cursor.execute(SQL_UPDATE_USER_DEBIT, (cost, request.user_id))
+        
+        new_balance = user_credits - cost
+    else:
+        new_balance = user_credits
+    
+    new_cost_level = cost_level + COST_INCREMENT_CREDITS
+    
+    # Write/update pixel
+    cursor.execute(SQL_UPSERT_PIXEL, (request.x, request.y, pixel_color(request), new_cost_level,
+                                      week_epoch, request.user_id))
+    
+    # Log placement
+    cursor.execute(SQL_INSERT_PLACEMENT, (request.user_id, request.x, request.y, request.color,
+                                          cost, is_free, request.is_ad))
+    
+    # Update last placement time now (flushed to global_state lazily) so the
+    # rest of the batch sees it
+    set_state("last_placement", time.time())
+    
+    # Update dynamic cap
+    record_cost_level(index, cost_level, new_cost_level)
+    update_dynamic_cap(current_cap)
+    
+    message = "Pixel placed"
+    if is_free:
+        message += f" (free: {free_reason})"
+    
+    return PlacePixelResponse(
+        success=True,
+        cost=cost,
+        was_free=is_free,
+        new_balance=new_balance,
+        message=message
+    )
 
 @app.get("/user/{user_id}")
-async def get_user(user_id: int):
+def get_user(user_id: int):
     """Get user information"""
     with get_db() as conn:
         cursor = conn.cursor()
@@ -469,7 +929,10 @@ async def get_user(user_id: int):
 @app.post("/user/create")
 async def create_user(username: str, initial_credits: int = 0):
     """Create a new user (for testing)"""
-    with get_db() as conn:
+    return await run_in_writer(insert_user, username, initial_credits)
+
+def insert_user(username, initial_credits):
+    with get_db(immediate=True) as conn:
         cursor = conn.cursor()
         try:
             cursor.execute("""
@@ -490,33 +953,32 @@ async def create_user(username: str, initial_credits: int = 0):
             raise HTTPException(status_code=400, detail="Username already exists")
 
 @app.get("/stats")
-async def get_stats():
+def get_stats(if_none_match: Optional[str] = Header(None)):
     """Get global statistics"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        
-        week_start = get_week_start(conn)
-        last_placement = get_last_placement_time(conn)
-        current_cap = get_current_cap(conn)
-        
-        cursor.execute("SELECT COUNT(*) FROM pixels")
-        total_pixels = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            SELECT COUNT(*) FROM placements
-            WHERE placed_at >= ?
-        """, (week_start.isoformat(),))
-        week_placements = cursor.fetchone()[0]
-        
-        return {
-            "board_size": BOARD_SIZE,
-            "total_pixels_placed": total_pixels,
-            "week_start": week_start.isoformat(),
-            "week_placements": week_placements,
-            "last_placement": last_placement.isoformat(),
-            "current_cap_credits": current_cap,
-            "current_cap_dollars": current_cap / 100000
-        }
+    def build():
+        with get_db() as conn:
+            cursor = conn.cursor()
+            
+            week_start = get_week_start()
+            last_placement = get_last_placement_time()
+            current_cap = get_current_cap()
+            
+            cursor.execute("SELECT COUNT(*) FROM pixels")
+            total_pixels = cursor.fetchone()[0]
+            
+            week_placements = get_week_placement_count()
+            
+            return json.dumps({
+                "board_size": BOARD_SIZE,
+                "total_pixels_placed": total_pixels,
+                "week_start": format_timestamp(week_start),
+                "week_placements": week_placements,
+                "last_placement": format_timestamp(last_placement),
+                "current_cap_credits": current_cap,
+                "current_cap_dollars": current_cap / 100000
+            }).encode()
+    
+    return cached_json_response("stats", if_none_match, build)
 
 if __name__ == "__main__":
     import uvicorn